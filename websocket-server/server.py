@@ -2,10 +2,13 @@ import asyncio
 import contextlib
 import json
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 
 import aiohttp
+import fastjsonschema
+import orjson
 from aiohttp import web
 
 ROOT_DIR = Path(__file__).resolve().parent
@@ -13,12 +16,17 @@ PUBLIC_DIR = ROOT_DIR / 'public'
 CONNECTED = set()
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s')
+logger = logging.getLogger(__name__)
+
+ERR_NOT_JSON = orjson.dumps({'type': 'error', 'message': 'JSONではありません'})
 
 OLLAMA_ENDPOINT = 'http://ollama-no-gpu:11434/api/generate'
 OLLAMA_MODEL = 'gemma3:4b'
+OLLAMA_SEM = asyncio.Semaphore(4)
 SCHEMA_PATH = ROOT_DIR / 'message-schema.json'
 with open(SCHEMA_PATH, encoding='utf-8') as schema_file:
     MESSAGE_SCHEMA_TEXT = schema_file.read().strip()
+VALIDATE_MESSAGE = fastjsonschema.compile(json.loads(MESSAGE_SCHEMA_TEXT))
 
 OLLAMA_PROMPT = """You are Jarvis controlling a 6-axis robot arm. Each joint controls:
 - j1: Base yaw (rotation, -180 to 180 degrees)
@@ -32,30 +40,49 @@ Schema:
 {schema}
 Command: "{command}"
 Respond with JSON only (no explanation)."""
+PROMPT_HEAD, PROMPT_TAIL = OLLAMA_PROMPT.replace('{schema}', MESSAGE_SCHEMA_TEXT).split('{command}', 1)
+
+ISO_SECOND_CACHE = {'sec': None, 'text': ''}
+
+def iso_now() -> str:
+    ns = time.time_ns()
+    sec = ns // 1_000_000_000
+    if ISO_SECOND_CACHE['sec'] != sec:
+        ISO_SECOND_CACHE['sec'] = sec
+        ISO_SECOND_CACHE['text'] = datetime.fromtimestamp(sec, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return f"{ISO_SECOND_CACHE['text']}.{(ns // 1000) % 1_000_000:06d}"
+
+def dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+def json_response(data, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
 
-async def query_ollama_payload(command: str) -> dict | None:
-    prompt = OLLAMA_PROMPT.replace('{command}', command).replace('{schema}', MESSAGE_SCHEMA_TEXT)
-    timeout = aiohttp.ClientTimeout(total=60)
+async def query_ollama_payload(command: str, session: aiohttp.ClientSession) -> dict | None:
+    prompt = f'{PROMPT_HEAD}{command}{PROMPT_TAIL}'
     try:
-        logging.info('Sending request to Ollama with prompt: %s', prompt)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        logger.info('Sending request to Ollama, prompt chars=%d', len(prompt))
+        logger.debug('Ollama prompt: %s', prompt)
+        async with OLLAMA_SEM:
             async with session.post(
                 OLLAMA_ENDPOINT,
                 json={'model': OLLAMA_MODEL, 'prompt': prompt, 'stream': False}
-            ) as response:                
+            ) as response:
                 if response.status != 200:
-                    logging.error('Ollama returned status %d', response.status)
+                    logger.error('Ollama returned status %d', response.status)
                     return None
-                
-                result = await response.json()
-                logging.info('Ollama response: %s', result)
+
+                raw = await response.read()
+                result = orjson.loads(raw)
+                logger.info('Ollama response bytes=%d', len(raw))
+                logger.debug('Ollama response: %s', result)
     except Exception:
-        logging.exception('Error querying Ollama')
+        logger.exception('Error querying Ollama')
         return None
     text_candidates = []
     if 'output' in result:
         output = result['output']
-        logging.info('Ollama output field found')
+        logger.info('Ollama output field found')
         if isinstance(output, list):
             text_candidates.append(''.join(output))
         elif isinstance(output, str):
@@ -65,92 +92,95 @@ async def query_ollama_payload(command: str) -> dict | None:
     if 'content' in result and isinstance(result['content'], str):
         text_candidates.append(result['content'])
     if not text_candidates:
-        logging.error('No textual field returned by Ollama, keys=%s', list(result.keys()))
+        logger.error('No textual field returned by Ollama, keys=%s', list(result.keys()))
         return None
     text = next((t for t in text_candidates if t and t.strip()), '')
-    def sanitize_response(raw: str) -> str:
-        cleaned = raw.strip()
-        if cleaned.startswith('```'):
-            cleaned = cleaned.split('\n', 1)[1] if '\n' in cleaned else ''
-        if cleaned.endswith('```'):
-            cleaned = cleaned.rsplit('```', 1)[0]
-        return cleaned.strip()
-
-    text = sanitize_response(text)
-    if not text:
-        return None
-
-    text = sanitize_response(text)
-    if not text:
+    start = text.find('{')
+    end = text.rfind('}')
+    if start < 0 or end < start:
+        logger.info('Ollama response is not JSON')
         return None
-    decoder = json.JSONDecoder()
+    candidate = text[start:end + 1]
     try:
-        decoded, _ = decoder.raw_decode(text)
-        return decoded
-    except json.JSONDecodeError:
-        logging.info('Ollama response is not JSON')
+        decoded = orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        try:
+            decoded, _ = json.JSONDecoder().raw_decode(candidate)
+        except json.JSONDecodeError:
+            logger.info('Ollama response is not JSON')
+            return None
+    try:
+        VALIDATE_MESSAGE(decoded)
+    except fastjsonschema.JsonSchemaException as exc:
+        logger.info('Ollama response does not match schema: %s', exc.message)
         return None
+    return decoded
 
 async def send_broadcast(payload, origin=None):
-    text = json.dumps(payload, ensure_ascii=False)
-    for ws in set(CONNECTED):
-        if ws.closed:
-            CONNECTED.discard(ws)
-            continue
-        try:
-            if ws is origin:
-                await ws.send_str(json.dumps({**payload, 'selfEcho': True}, ensure_ascii=False))
-            else:
-                await ws.send_str(text)
-        except Exception:
-            CONNECTED.discard(ws)
+    data = orjson.dumps(payload)
+    echo_data = None
+    if origin is not None and origin in CONNECTED:
+        echo_data = orjson.dumps({**payload, 'selfEcho': True})
+    targets = [ws for ws in CONNECTED.copy() if not ws.closed]
+    results = await asyncio.gather(
+        *(ws.send_frame(echo_data if ws is origin else data, web.WSMsgType.TEXT) for ws in targets),
+        return_exceptions=True
+    )
+    CONNECTED.difference_update(
+        ws for ws, result in zip(targets, results) if isinstance(result, Exception)
+    )
 
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(compress=False)
     await ws.prepare(request)
 
     CONNECTED.add(ws)
     welcome = {
         'type': 'info',
         'message': '接続しました',
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': iso_now()
     }
-    await ws.send_str(json.dumps(welcome, ensure_ascii=False))
-    logging.info('client connected, total=%d', len(CONNECTED))
+    await ws.send_str(dumps(welcome))
+    logger.info('client connected, total=%d', len(CONNECTED))
 
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
-                payload = msg.data.strip()
-                logging.info('受信: %s', payload)
+                logger.info('ws recv bytes=%d', len(msg.data))
+                logger.debug('受信: %s', msg.data)
+                try:
+                    data = msg.json(loads=orjson.loads)
+                except orjson.JSONDecodeError:
+                    await ws.send_frame(ERR_NOT_JSON, web.WSMsgType.TEXT)
+                    continue
                 try:
-                    data = json.loads(payload)
-                except json.JSONDecodeError:
-                    await ws.send_str(json.dumps({
+                    VALIDATE_MESSAGE(data)
+                except fastjsonschema.JsonSchemaException as exc:
+                    await ws.send_str(dumps({
                         'type': 'error',
-                        'message': 'JSONではありません',
-                        'raw': payload
-                    }, ensure_ascii=False))
+                        'message': 'スキーマに一致しません',
+                        'detail': exc.message
+                    }))
                     continue
 
                 await send_broadcast({
                     'type': 'broadcast',
                     'origin': 'client',
-                    'timestamp': datetime.utcnow().isoformat(),
+                    'timestamp': iso_now(),
                     'body': data
                 }, origin=ws)
             elif msg.type == web.WSMsgType.ERROR:
-                logging.error('WebSocket error: %s', ws.exception())
+                logger.error('WebSocket error: %s', ws.exception())
     finally:
         CONNECTED.discard(ws)
-        logging.info('client disconnected, total=%d', len(CONNECTED))
+        logger.info('client disconnected, total=%d', len(CONNECTED))
     return ws
 
 async def index_handler(request):
     return web.FileResponse(PUBLIC_DIR / 'index.html')
 
 async def health(request):
-    return web.json_response({'status': 'ready', 'clients': len(CONNECTED)})
+    return json_response({'status': 'ready', 'clients': len(CONNECTED)})
 
 async def ollama_handler(request):
     try:
@@ -159,34 +189,44 @@ async def ollama_handler(request):
         data = {}
     command = (data.get('command') or data.get('prompt') or '').strip()
     if not command:
-        return web.json_response({'error': 'command is required'}, status=400)
-    logging.info('Received command: %s', command)
+        return json_response({'error': 'command is required'}, status=400)
+    logger.info('Received command: %s', command)
 
-    payload = await query_ollama_payload(command)
-    logging.info('Ollama payload: %s', payload)
+    payload = await query_ollama_payload(command, request.app['ollama_session'])
+    logger.debug('Ollama payload: %s', payload)
     if payload is None:
-        return web.json_response({'error': 'failed to generate payload'}, status=502)
+        return json_response({'error': 'failed to generate payload'}, status=502)
 
     await send_broadcast({
         'type': 'broadcast',
         'origin': 'ollama',
-        'timestamp': datetime.utcnow().isoformat(),
+        'timestamp': iso_now(),
         'body': payload
     })
 
-    return web.json_response({'status': 'ok', 'payload': payload})
+    return json_response({'status': 'ok', 'payload': payload})
 
 async def periodic_server_time():
     while True:
         await asyncio.sleep(10)
         if not CONNECTED:
             continue
+        ts = iso_now()
         payload = {
             'type': 'heartbeat',
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': ts
         }
         await send_broadcast(payload)
 
+async def init_ollama_session(app):
+    app['ollama_session'] = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=60),
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=30)
+    )
+
+async def close_ollama_session(app):
+    await app['ollama_session'].close()
+
 async def start_background(app):
     app['heartbeat'] = asyncio.create_task(periodic_server_time())
 
@@ -201,8 +241,16 @@ app.router.add_get('/ws', websocket_handler)
 app.router.add_get('/health', health)
 app.router.add_post('/ollama', ollama_handler)
 app.router.add_static('/static/', path=PUBLIC_DIR, name='static')
+app.on_startup.append(init_ollama_session)
 app.on_startup.append(start_background)
 app.on_cleanup.append(stop_background)
+app.on_cleanup.append(close_ollama_session)
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+    except ImportError:
+        logger.info('uvloop not installed, using default asyncio event loop')
+    else:
+        uvloop.install()
     web.run_app(app, port=3000)